@@ -2,43 +2,126 @@ import os
 import subprocess
 import tempfile
 import contextlib
+import collections
+import errno
+import hashlib
 import math
+import re
+import secrets
 import textwrap
+import threading
 
 from ipykernel.kernelbase import Kernel
 
 
+BUILD_CACHE_SIZE = 64
+# staging only: /dev/shm is often mounted noexec, so nothing is run from here
+BUILD_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+_build_cache = collections.OrderedDict()
+_build_cache_lock = threading.Lock()
+
+
 def build_binary(source):
-    cmd = [
-        "/usr/bin/gcc",
-        "-x",
-        "assembler",
-        "-nostdlib",
-        "-no-pie",
-        "-",
-        "-o",
-        "/dev/stdout",
-    ]
-    binary = subprocess.check_output(cmd, input=source.encode(), stderr=subprocess.PIPE)
+    key = hashlib.sha256(source).digest()
+    with _build_cache_lock:
+        if key in _build_cache:
+            _build_cache.move_to_end(key)
+            return _build_cache[key]
+
+    # as and ld both need seekable output, so stage through tmpfs
+    with tempfile.TemporaryDirectory(dir=BUILD_DIR) as build_dir:
+        object_path = os.path.join(build_dir, "binary.o")
+        binary_path = os.path.join(build_dir, "binary")
+        subprocess.check_output(
+            ["/usr/bin/as", "--64", "-o", object_path],
+            input=source,
+            stderr=subprocess.PIPE,
+            close_fds=False,
+        )
+        subprocess.check_output(
+            ["/usr/bin/ld", "-static", "-o", binary_path, object_path],
+            stderr=subprocess.PIPE,
+            close_fds=False,
+        )
+        with open(binary_path, "rb") as f:
+            binary = f.read()
+
+    with _build_cache_lock:
+        _build_cache[key] = binary
+        if len(_build_cache) > BUILD_CACHE_SIZE:
+            _build_cache.popitem(last=False)
     return binary
 
 
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
 @contextlib.contextmanager
 def temp_binary(binary):
-    with tempfile.NamedTemporaryFile(delete=False) as f:
-        f.write(binary)
-    path = f.name
-    os.chmod(path, 0o755)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC
+    while True:
+        name = f"asm-{os.getpid()}-{secrets.token_hex(8)}"
+        path = os.path.join(tempfile.gettempdir(), name)
+        try:
+            fd = os.open(path, flags, 0o755)
+            break
+        except FileExistsError:
+            continue
     try:
+        try:
+            write_all(fd, binary)
+        finally:
+            os.close(fd)
         yield path
     finally:
         os.unlink(path)
 
 
+MFD_EXEC = getattr(os, "MFD_EXEC", 0x10)
+
+
+def memfd_create_exec(name):
+    if not hasattr(os, "memfd_create"):
+        return None
+    try:
+        return os.memfd_create(name, os.MFD_CLOEXEC | MFD_EXEC)
+    except OSError as e:
+        # kernels before 6.3 reject MFD_EXEC, but their memfds are always executable
+        if e.errno == errno.EINVAL:
+            return os.memfd_create(name)
+        # vm.memfd_noexec=2 refuses executable memfds outright
+        if e.errno in (errno.EACCES, errno.EPERM):
+            return None
+        raise
+
+
+@contextlib.contextmanager
+def memfd_binary(binary):
+    fd = memfd_create_exec("asm")
+    if fd is None:
+        with temp_binary(binary) as path:
+            yield path
+        return
+
+    try:
+        write_all(fd, binary)
+        os.set_inheritable(fd, True)
+        yield f"/proc/self/fd/{fd}"
+    finally:
+        os.close(fd)
+
+
 @contextlib.contextmanager
 def run_binary(binary, *args, gdb_script=None, **kwargs):
     for name in ["stdin", "stdout", "stderr"]:
         kwargs.setdefault(name, subprocess.PIPE)
+    # the memfd must survive into the child for /proc/self/fd/N to resolve, and
+    # without close_fds subprocess can launch via posix_spawn rather than fork
+    kwargs.setdefault("close_fds", False)
 
     cmd = []
     if gdb_script:
@@ -53,32 +136,40 @@ def run_binary(binary, *args, gdb_script=None, **kwargs):
             "--args",
         ]
 
-    with temp_binary(binary) as binary_path:
+    # gdb needs a real path to load symbols from; otherwise exec straight from memory
+    binary_context = temp_binary if gdb_script else memfd_binary
+    with binary_context(binary) as binary_path:
         cmd += [binary_path, *args]
         process = subprocess.Popen(cmd, **kwargs)
         try:
             yield process
         finally:
-            process.kill()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
             if gdb_script:
                 os.unlink(script.name)
 
 
 def html(element):
-    def html_recursive(element):
+    def html_recursive(element, out):
         if isinstance(element, dict):
             assert len(element) >= 1
-            node, *attrs = list(element.items())
+            node, *attrs = element.items()
             name, value = node
             attrs = " ".join(f'{attr}="{value}"' for attr, value in attrs)
-            yield f"<{name} {attrs}>" + "".join(html_recursive(value)) + f"</{name}>"
+            out.append(f"<{name} {attrs}>")
+            html_recursive(value, out)
+            out.append(f"</{name}>")
         elif isinstance(element, (list, tuple)):
             for value in element:
-                yield from html_recursive(value)
+                html_recursive(value, out)
         else:
-            yield str(element)
+            out.append(str(element))
 
-    return "".join(html_recursive(element))
+    out = []
+    html_recursive(element, out)
+    return "".join(out)
 
 
 class ASMRepl:
@@ -98,16 +189,17 @@ class ASMRepl:
     def __init__(self):
         self.code_blocks = []
         self.gdb = None
+        self._code = None
         if self.__class__ == ASMRepl:
             raise NotImplementedError()
 
     @property
     def code(self):
-        code = self.asm_prefix
-        code += "".join(f"{block}\n" for block in self.code_blocks)
-        code += self.asm_suffix
-        code = code.strip()
-        return code
+        if self._code is None:
+            blocks = b"".join(block + b"\n" for block in self.code_blocks)
+            prefix, suffix = self.asm_prefix.encode(), self.asm_suffix.encode()
+            self._code = (prefix + blocks + suffix).strip()
+        return self._code
 
     @property
     def gdb_script(self):
@@ -127,94 +219,123 @@ class ASMRepl:
 
     def reset(self):
         self.code_blocks.clear()
+        self._code = None
 
 
 class EditableASMRepl(ASMRepl):
+    # numeric local labels (1:) are reusable, so they stay inside their block
+    label_re = re.compile(r"^[ \t]*([A-Za-z_$][\w.$]*)[ \t]*:", re.M)
+
     def __init__(self):
         super().__init__()
         self.labels = {}
         self.code_blocks = self.labels.values()
 
     def read(self, code):
-        label = None
-        content = ""
-        for line in code.split("\n"):
-            line = line.strip()
-            if not line.startswith(".") and ":" in line:
-                if label:
-                    self.labels[label] = content
-                label = line[: line.index(":")]
-                content = ""
-            content += f"{line}\n"
-        if label:
-            self.labels[label] = content
+        matches = list(self.label_re.finditer(code))
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            end = next_match.start() if next_match else len(code)
+            self.labels[match.group(1)] = code[match.start() : end].encode()
+        self._code = None
         return "_start" in code
 
     def reset(self):
         self.labels.clear()
+        self._code = None
 
 
 class LinearASMRepl(ASMRepl):
     asm_prefix = ASMRepl.asm_prefix + "_start:\n"
 
-    @property
-    def gdb_script(self):
-        def tbreak(address):
-            return [
+    gdb_registers = [
+        "rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "rsp", "r8", "r9",
+        "r10", "r11", "r12", "r13", "r14", "r15", "rip", "eflags", "fs_base",
+        "gs_base",
+    ]  # fmt: skip
+    eflags_bits = {
+        0: "CF", 2: "PF", 4: "AF", 6: "ZF", 7: "SF", 8: "TF", 9: "IF", 10: "DF",
+        11: "OF", 14: "NT", 16: "RF", 17: "VM", 18: "AC", 19: "VIF", 20: "VIP",
+        21: "ID",
+    }  # fmt: skip
+
+    gdb_section_re = re.compile(
+        r"^###start (\S+) (\S+)\n((?:(?!^###start ).)*?)^###end$", re.M | re.S
+    )
+    gdb_register_re = re.compile(r"^(\w+)=(\S+)$", re.M)
+
+    def __init__(self):
+        super().__init__()
+        self.gdb_breakpoints = []
+
+    @classmethod
+    def tbreak(cls, address):
+        register_format = "\\n".join(f"{name}=0x%lx" for name in cls.gdb_registers)
+        register_args = ", ".join(f"${name}" for name in cls.gdb_registers)
+        return "\n".join(
+            [
                 f"tbreak {address}",
                 "commands",
                 f'printf "###start registers {address}\\n"',
-                "info registers",
+                f'printf "{register_format}\\n", {register_args}',
                 f'printf "###end\\n"',
                 "continue",
                 "end",
             ]
+        )
 
-        script = []
-        for block_id in range(len(self.code_blocks)):
-            script += tbreak(f".block.{block_id}")
-        script += tbreak(".end")
-        script += ["run"]
-        return "\n".join(script)
+    @property
+    def gdb_script(self):
+        return "\n".join([*self.gdb_breakpoints, self.tbreak(".end"), "run"])
 
     def read(self, code):
         block_id = len(self.code_blocks)
         code = f".block.{block_id}:\n" + code
-        self.code_blocks.append(code)
+        self.code_blocks.append(code.encode())
+        self.gdb_breakpoints.append(self.tbreak(f".block.{block_id}"))
+        self._code = None
         return True
 
+    def reset(self):
+        super().reset()
+        self.gdb_breakpoints.clear()
+
     def evaluate(self, *args, **kwargs):
         result = super().evaluate(*args, **kwargs)
 
         gdb_output = result["stdout"].decode()
-        state = None
-        block = None
         gdb_data = {}
-        for line in gdb_output.split("\n"):
-            if line.startswith("###start"):
-                _, state, block = line.split()
-                gdb_data[block] = {}
-            elif line == "###end":
-                state = None
-            elif state == "registers":
-                register, value, extra = line.split(maxsplit=2)
-                gdb_data[block][register] = (value, extra)
+        for state, block, section in self.gdb_section_re.findall(gdb_output):
+            if state == "registers":
+                registers = dict(self.gdb_register_re.findall(section))
+                if not set(self.gdb_registers) <= registers.keys():
+                    continue
+                eflags = int(registers["eflags"], 16)
+                flags = "".join(
+                    f"{flag} "
+                    for bit, flag in self.eflags_bits.items()
+                    if eflags >> bit & 1
+                )
+                registers["eflags"] = f"[ {flags}]"
+                gdb_data[block] = registers
+
+        # e.g. gdb rejected the printf, or the program died before .end
+        last_block = f".block.{len(self.code_blocks) - 1}"
+        if last_block not in gdb_data or ".end" not in gdb_data:
+            raise subprocess.CalledProcessError(
+                result["returncode"],
+                "/usr/bin/gdb",
+                output=result["stdout"],
+                stderr=result["stdout"] + result["stderr"],
+            )
 
         return self.print_result(gdb_data)
 
     def print_result(self, gdb_data):
-        def register_values(block_id):
-            return {
-                k: (v[0] if k != "eflags" else v[1])
-                for k, v in gdb_data[block_id].items()
-                if k not in ["cs", "ss", "ds", "es", "fs", "gs"]
-            }
-
-        registers = register_values(".end")
+        registers = gdb_data[".end"]
         last_block_id = len(self.code_blocks) - 1
         changed = {
             k
-            for k, v in register_values(f".block.{last_block_id}").items()
+            for k, v in gdb_data[f".block.{last_block_id}"].items()
             if v != registers[k]
         }
 
@@ -235,7 +356,8 @@ class LinearASMRepl(ASMRepl):
         rows = math.ceil(len(registers) / columns)
 
         def register_element(row, column):
-            return registers[len(registers) // columns * column + row]
+            index = rows * column + row
+            return registers[index] if index < len(registers) else ""
 
         result = {}
         result["registers"] = html(
@@ -273,6 +395,11 @@ class ASMKernel(Kernel):
         super().__init__(*args, **kwargs)
         # self.asm_repl = EditableASMRepl()
         self.asm_repl = LinearASMRepl()
+        self.readelf_cache = collections.OrderedDict()
+        # warm the page cache for as/ld and seed the build cache with the empty program
+        threading.Thread(
+            target=build_binary, args=(self.asm_repl.code,), daemon=True
+        ).start()
 
     def do_execute(
         self, code, silent, store_history=True, user_expressions=None, allow_stdin=False
@@ -323,16 +450,28 @@ class ASMKernel(Kernel):
         }
 
     def magic_readelf(self):
-        binary = build_binary(self.asm_repl.code)
-        with temp_binary(binary) as binary_path:
-            readelf = subprocess.check_output(["/usr/bin/readelf", "-a", binary_path])
-            return dict(readelf=readelf)
+        source = self.asm_repl.code
+        key = hashlib.sha256(source).digest()
+        if key in self.readelf_cache:
+            self.readelf_cache.move_to_end(key)
+            return dict(readelf=self.readelf_cache[key])
+
+        binary = build_binary(source)
+        with memfd_binary(binary) as binary_path:
+            readelf = subprocess.check_output(
+                ["/usr/bin/readelf", "-a", binary_path], close_fds=False
+            )
+        self.readelf_cache[key] = readelf
+        if len(self.readelf_cache) > BUILD_CACHE_SIZE:
+            self.readelf_cache.popitem(last=False)
+        return dict(readelf=readelf)
 
     def magic_asm(self):
-        return dict(asm=self.asm_repl.code.encode())
+        return dict(asm=self.asm_repl.code)
 
     def magic_reset(self):
         self.asm_repl.reset()
+        self.readelf_cache.clear()
 
     def magic_gdb(self, code):
         _, _, script = code.partition("\n")